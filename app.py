@@ -3,9 +3,20 @@ import pyodbc
 
 import os
 import io
+import re
+import sys
+import gzip
+import json
+import threading
+import queue
+import uuid
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment
 from flask import send_file, request, redirect, url_for
+from urllib.parse import urlencode
 import pandas as pd
 
 app = Flask(__name__)
@@ -15,6 +26,56 @@ FILIAIS = ["09ALFA01", "09ALFA07", "09ALFA02", "09ALFA06", "09ALFA03"]
 # String para display (ou log)
 FILIAIS_STR = ", ".join(FILIAIS)
 
+# Escopos de comparação: perfil -> {empresa: [filiais]}
+# Empresa "01" = tabela SB2010, "02" = SB2020, ...
+# Perfis extras via ENV SB2_ESCOPOS (JSON), ex: {"beta": {"02": ["09BETA01"]}}
+ESCOPO_PADRAO = "padrao"
+ESCOPOS = {ESCOPO_PADRAO: {"01": FILIAIS}}
+ESCOPOS.update(json.loads(os.environ.get("SB2_ESCOPOS", "{}")))
+
+# Empresa/filial entram no nome da tabela e dos arquivos: só alfanumérico
+_CODIGO_RE = re.compile(r"^[A-Za-z0-9]+$")
+for _perfil, _empresas in ESCOPOS.items():
+    for _empresa, _filiais in _empresas.items():
+        if not _CODIGO_RE.match(_empresa) or not all(_CODIGO_RE.match(f) for f in _filiais):
+            raise RuntimeError(f"Escopo '{_perfil}' inválido: empresa/filial devem ser alfanuméricas.")
+
+class EscopoErro(Exception):
+    """Escopo/empresa desconhecido na requisição (vira HTTP 400)"""
+
+def tabela_sb2(empresa):
+    return f"SB2{empresa}0"
+
+def resolve_particoes(escopo=None, empresa=None, filial_filter='all'):
+    """
+    Lista as partições (empresa, filial) do escopo, na ordem do perfil.
+    `empresa` e `filial_filter` (mesmo formato do filtro da tela) restringem o escopo,
+    assim quem olha uma filial só carrega aquela partição.
+    """
+    perfil = ESCOPOS.get(escopo or ESCOPO_PADRAO)
+    if perfil is None:
+        raise EscopoErro(f"Escopo '{escopo}' não configurado.")
+    if empresa and empresa not in perfil:
+        raise EscopoErro(f"Empresa '{empresa}' fora do escopo.")
+
+    target_filiais = None if filial_filter == 'all' else filial_filter.split(',')
+    particoes = []
+    for emp, filiais in perfil.items():
+        if empresa and emp != empresa:
+            continue
+        for f in filiais:
+            if target_filiais is None or f in target_filiais:
+                particoes.append((emp, f))
+    return particoes
+
+def filiais_do_escopo(escopo=None, empresa=None):
+    """Filiais distintas do escopo (para o filtro da tela)"""
+    filiais = []
+    for _emp, f in resolve_particoes(escopo, empresa):
+        if f not in filiais:
+            filiais.append(f)
+    return filiais
+
 TESTE_SQL = {
     "server": os.environ.get("MSSQL_HOST_TST", "192.168.0.246"),
     "database": os.environ.get("MSSQL_DB_TST", "protheus12_producao"),
@@ -69,29 +130,58 @@ def connect_sql(cfg: dict):
 def _trim(v):
     return v.rstrip() if isinstance(v, str) else v
 
-def get_produtos_teste():
-    # Monta placeholders ?, ?
-    placeholders = ",".join("?" * len(FILIAIS))
-    
-    sql = f"""
-        SELECT B2_FILIAL, B2_COD, B2_LOCAL, B2_VATU1, B2_CM1, B2_QATU, B2_DMOV
-          FROM SB2010
-         WHERE B2_FILIAL IN ({placeholders})
-         AND D_E_L_E_T_ = ''
-         AND B2_COD <> ''
-         AND (
-             B2_VATU1 <> 0 
-             OR B2_CM1 <> 0 
-         )
-         ORDER BY B2_FILIAL, B2_COD, B2_LOCAL
-    """
-    with connect_sql(TESTE_SQL) as conn:
+# Tamanho do lote do fetchmany (permite reportar progresso/cancelar durante a leitura)
+FETCH_BATCH = 5000
+
+def _fetch_rows(cur, progress=None, etapa=""):
+    rows = []
+    while True:
+        batch = cur.fetchmany(FETCH_BATCH)
+        if not batch:
+            break
+        rows.extend(batch)
+        if progress:
+            progress(etapa=etapa, linhas_lidas=len(rows))
+    return rows
+
+def _query_sb2(cfg, particoes, progress=None, etapa=""):
+    # Agrupa as partições por empresa: uma consulta por tabela SB2xx0
+    if not particoes:
+        return []
+    por_empresa = {}
+    for empresa, filial in particoes:
+        por_empresa.setdefault(empresa, []).append(filial)
+
+    result = []
+    with connect_sql(cfg) as conn:
         cur = conn.cursor()
-        cur.execute(sql, tuple(FILIAIS))
-        rows = cur.fetchall()
-
-        # [(filial, cod, local, vatu1, cm1, qatu, dmov), ...]
-        return [(_trim(r.B2_FILIAL), _trim(r.B2_COD), _trim(r.B2_LOCAL), r.B2_VATU1, r.B2_CM1, r.B2_QATU, _trim(r.B2_DMOV)) for r in rows]
+        for empresa, filiais in por_empresa.items():
+            # Monta placeholders ?, ?
+            placeholders = ",".join("?" * len(filiais))
+
+            sql = f"""
+                SELECT B2_FILIAL, B2_COD, B2_LOCAL, B2_VATU1, B2_CM1, B2_QATU, B2_DMOV
+                  FROM {tabela_sb2(empresa)}
+                 WHERE B2_FILIAL IN ({placeholders})
+                 AND D_E_L_E_T_ = ''
+                 AND B2_COD <> ''
+                 AND (
+                     B2_VATU1 <> 0 
+                     OR B2_CM1 <> 0 
+                 )
+                 ORDER BY B2_FILIAL, B2_COD, B2_LOCAL
+            """
+            cur.execute(sql, tuple(filiais))
+            rows = _fetch_rows(cur, progress, etapa=etapa)
+
+            # [(filial, cod, local, vatu1, cm1, qatu, dmov), ...]
+            result.extend((_trim(r.B2_FILIAL), _trim(r.B2_COD), _trim(r.B2_LOCAL), r.B2_VATU1, r.B2_CM1, r.B2_QATU, _trim(r.B2_DMOV)) for r in rows)
+    return result
+
+def get_produtos_teste(particoes=None, progress=None):
+    if particoes is None:
+        particoes = resolve_particoes()
+    return _query_sb2(TESTE_SQL, particoes, progress, etapa="teste")
 
 def sync_to_prod(produtos):
     # Atualiza só se existir e só se mudou
@@ -154,25 +244,134 @@ import math
 
 import time
 
-# Cache Global simples
-CACHE_DATA = None
-CACHE_TIMESTAMP = None
+# Cache por partição (empresa, filial), em ordem de uso (LRU)
+PARTICOES = OrderedDict()
+PARTICOES_LOCK = threading.Lock()
+# Um lock por partição: a mesma partição nunca é carregada duas vezes em paralelo,
+# mas partições diferentes carregam independentemente
+_PARTICAO_LOCKS = {}
+# Orçamento de memória do cache (MB, estimado); acima disso as partições menos usadas saem
+CACHE_MAX_MB = int(os.environ.get("SB2_CACHE_MAX_MB", 512))
+# Quantas partições buscar em paralelo no SQL
+PARTICOES_PARALELAS = int(os.environ.get("SB2_PARTICOES_PARALELAS", 4))
 # Cache para Exportação da Análise de Importação
 LATEST_IMPORT_DATA = []
 
-def get_cached_data(force_reload=False):
-    global CACHE_DATA, CACHE_TIMESTAMP
-    
-    # Se já tem dados e não forçado, retorna cache
-    if CACHE_DATA is not None and not force_reload:
-        return CACHE_DATA
+def _particao_lock(chave):
+    with PARTICOES_LOCK:
+        return _PARTICAO_LOCKS.setdefault(chave, threading.Lock())
+
+def _estimate_bytes(rows):
+    """Estimativa grosseira do tamanho de uma partição (amostra da 1ª linha)"""
+    if not rows:
+        return sys.getsizeof(rows)
+    amostra = rows[0]
+    por_linha = sys.getsizeof(amostra) + sum(sys.getsizeof(v) for v in amostra.values())
+    return sys.getsizeof(rows) + por_linha * len(rows)
+
+def _evict_particoes(manter):
+    """Remove partições menos usadas até caber no orçamento (nunca as de `manter`)"""
+    limite = CACHE_MAX_MB * 1024 * 1024
+    with PARTICOES_LOCK:
+        total = sum(p["bytes"] for p in PARTICOES.values())
+        for chave in list(PARTICOES):
+            if total <= limite:
+                break
+            if chave in manter:
+                continue
+            total -= PARTICOES.pop(chave)["bytes"]
+            print(f"--- [CACHE EVICT] Partição {chave[0]}/{chave[1]} ---")
 
-    print("--- [CACHE MISS] Carregando dados do SQL... ---")
+def get_cached_data(force_reload=False, progress=None, particoes=None):
+    """
+    Retorna os dados de comparação das partições pedidas (padrão: escopo padrão inteiro).
+    Partições ausentes (ou todas, se force_reload) são buscadas em paralelo.
+    """
+    if particoes is None:
+        particoes = resolve_particoes()
+
+    # Guarda as listas de cada partição pedida: uma eviction de outra requisição
+    # entre a carga e a montagem do resultado não pode sumir com elas
+    dados = {}
+    with PARTICOES_LOCK:
+        for c in particoes:
+            if not force_reload and c in PARTICOES:
+                dados[c] = PARTICOES[c]["dados"]
+                PARTICOES.move_to_end(c)
+    faltando = [c for c in particoes if c not in dados]
+
+    if faltando:
+        # Progresso agregado das partições carregando em paralelo
+        lidas = {}
+        carregadas = [0]
+        prog_lock = threading.Lock()
+
+        def _report():
+            if progress:
+                with prog_lock:
+                    total = sum(lidas.values())
+                progress(etapa="carregando", linhas_lidas=total,
+                         particoes_carregadas=carregadas[0], particoes_total=len(faltando))
+
+        def _progress_particao(chave):
+            def _cb(etapa="", linhas_lidas=0, **kwargs):
+                with prog_lock:
+                    lidas[(chave, etapa)] = linhas_lidas
+                _report()
+            return _cb
+
+        with ThreadPoolExecutor(max_workers=max(1, PARTICOES_PARALELAS)) as pool:
+            futures = {c: pool.submit(_load_particao, c, force_reload, _progress_particao(c)) for c in faltando}
+            for c, fut in futures.items():
+                # Propaga erro/cancelamento de qualquer partição
+                dados[c] = fut.result()
+                carregadas[0] += 1
+                _report()
+
+    result = []
+    # Ordena como o antigo ORDER BY B2_FILIAL (empresa, filial)
+    for chave in sorted(particoes):
+        result.extend(dados[chave])
+
+    _evict_particoes(set(particoes))
+    return result
+
+def particoes_faltando(particoes):
+    """Partições pedidas que ainda não estão no cache"""
+    with PARTICOES_LOCK:
+        return [c for c in particoes if c not in PARTICOES]
+
+def cache_timestamp(particoes=None):
+    """Horário da carga mais antiga entre as partições (o que está na tela)"""
+    if particoes is None:
+        particoes = resolve_particoes()
+    with PARTICOES_LOCK:
+        stamps = [PARTICOES[c]["carregado"] for c in particoes if c in PARTICOES]
+    # Compara o epoch e só formata para exibir (string HH:MM:SS quebra na virada do dia)
+    return time.strftime("%d/%m %H:%M:%S", time.localtime(min(stamps))) if stamps else None
+
+def _load_particao(chave, force_reload=False, progress=None):
+    """Carrega a partição (se preciso) e retorna sua lista de dados"""
+    with _particao_lock(chave):
+        # Outra thread pode ter carregado enquanto esperávamos o lock
+        with PARTICOES_LOCK:
+            if not force_reload and chave in PARTICOES:
+                PARTICOES.move_to_end(chave)
+                return PARTICOES[chave]["dados"]
+        part = _load_data(chave, progress)
+        with PARTICOES_LOCK:
+            PARTICOES[chave] = part
+            PARTICOES.move_to_end(chave)
+        return part["dados"]
+
+def _load_data(chave, progress=None):
+    empresa, filial = chave
+    print(f"--- [CACHE MISS] Carregando partição {empresa}/{filial} do SQL... ---")
     start_t = time.time()
     
     # 1. Busca dados
-    test_data = get_produtos_teste()
-    raw_prod = get_produtos_prod()
+    test_data = get_produtos_teste([chave], progress)
+    raw_prod = get_produtos_prod([chave], progress)
     # Chave agora inclui FILIAL para não misturar produtos iguais de filiais dif
     # Dict Key: (Filial, Cod, Local)
     prod_dict = {(r[0], r[1], r[2]): (r[3], r[4], r[5], r[6]) for r in raw_prod}
@@ -210,6 +409,7 @@ def get_cached_data(force_reload=False):
         has_diff = diff_vatu or diff_cm
         
         full_data.append({
+            "empresa": empresa,
             "filial": t_filial,
             "cod": t_cod,
             "local": t_local,
@@ -226,10 +426,326 @@ def get_cached_data(force_reload=False):
             "has_diff": has_diff
         })
 
-    print(f"--- [CACHE SET] Dados processados em {time.time() - start_t:.2f}s ---")
-    CACHE_DATA = full_data
-    CACHE_TIMESTAMP = time.strftime("%H:%M:%S")
-    return full_data
+    print(f"--- [CACHE SET] Partição {empresa}/{filial} processada em {time.time() - start_t:.2f}s ---")
+
+    # Guarda o snapshot da carga; falha aqui não pode derrubar a tela
+    try:
+        save_snapshot(full_data, chave)
+    except Exception as e:
+        print(f"--- [SNAPSHOT] Falha ao gravar snapshot: {e} ---")
+
+    return {
+        "dados": full_data,
+        "carregado": time.time(),
+        "bytes": _estimate_bytes(full_data),
+    }
+
+# ---------------------------------------------------------------------------
+# Snapshots históricos (um por carga de partição do SQL) e relatório de drift
+# ---------------------------------------------------------------------------
+
+SNAPSHOT_DIR = os.environ.get(
+    "SB2_SNAPSHOT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots"),
+)
+# Retenção por partição: quantidade máxima de snapshots e idade máxima (dias, 0 = sem limite)
+SNAPSHOT_MAX = int(os.environ.get("SB2_SNAPSHOT_MAX", 30))
+SNAPSHOT_MAX_DIAS = int(os.environ.get("SB2_SNAPSHOT_MAX_DIAS", 90))
+# Versão do formato gravado; formato 1 (sem empresa) ainda é lido como empresa "01"
+SNAPSHOT_FORMATO = 2
+
+SNAPSHOT_KEY = ["empresa", "filial", "cod", "local"]
+SNAPSHOT_VALORES = ["t_vatu", "t_cm", "t_qatu", "p_vatu", "p_cm", "p_qatu"]
+SNAPSHOT_FLAGS = ["diff_vatu", "diff_cm", "has_diff"]
+# Colunas repetitivas gravadas como categoria (lista de valores + códigos)
+SNAPSHOT_CATEGORIAS = ["empresa", "filial", "local", "t_dmov", "p_dmov"]
+
+# sb2_<id>_<empresa>_<filial>_<data>.json.gz (formato 1 não tinha empresa/filial)
+_SNAPSHOT_RE = re.compile(r"^sb2_(\d{6})(?:_([A-Za-z0-9]+)_([A-Za-z0-9]+))?_(\d{8}_\d{6})\.json\.gz$")
+SNAPSHOT_LOCK = threading.Lock()
+
+def _snapshot_df(full_data):
+    """Converte a lista de dicts do cache em DataFrame colunar compacto"""
+    df = pd.DataFrame(full_data, columns=SNAPSHOT_KEY + SNAPSHOT_VALORES + ["t_dmov", "p_dmov"] + SNAPSHOT_FLAGS)
+    # Colunas repetitivas viram category (empresa/filial/local/datas se repetem muito)
+    for c in SNAPSHOT_CATEGORIAS:
+        df[c] = df[c].fillna("").astype("category")
+    for c in SNAPSHOT_VALORES:
+        df[c] = df[c].astype("float64")
+    for c in SNAPSHOT_FLAGS:
+        df[c] = df[c].astype(bool)
+    return df
+
+def _df_to_colunas(df):
+    """DataFrame -> dict colunar só com dados (sem pickle): categorias viram {categorias, codigos}"""
+    colunas = {}
+    for c in df.columns:
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            colunas[c] = {
+                "categorias": [str(v) for v in df[c].cat.categories],
+                "codigos": df[c].cat.codes.tolist(),
+            }
+        else:
+            colunas[c] = df[c].tolist()
+    return colunas
+
+def _colunas_to_df(colunas):
+    """Inverso de _df_to_colunas, aplicando os dtypes explicitamente"""
+    series = {}
+    for c, v in colunas.items():
+        if isinstance(v, dict):
+            series[c] = pd.Categorical.from_codes(v["codigos"], categories=v["categorias"])
+        elif c in SNAPSHOT_VALORES:
+            series[c] = pd.Series(v, dtype="float64")
+        elif c in SNAPSHOT_FLAGS:
+            series[c] = pd.Series(v, dtype=bool)
+        else:
+            series[c] = pd.Series(v, dtype=object)
+    return pd.DataFrame(series)
+
+def list_snapshots():
+    """Lista snapshots gravados (mais antigo primeiro): [{'id', 'empresa', 'filial', 'criado', 'arquivo'}]"""
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    snaps = []
+    for nome in os.listdir(SNAPSHOT_DIR):
+        m = _SNAPSHOT_RE.match(nome)
+        if not m:
+            continue
+        criado = time.strptime(m.group(4), "%Y%m%d_%H%M%S")
+        snaps.append({
+            "id": int(m.group(1)),
+            "empresa": m.group(2),
+            "filial": m.group(3),
+            "criado": time.strftime("%Y-%m-%d %H:%M:%S", criado),
+            "arquivo": nome,
+        })
+    snaps.sort(key=lambda s: s["id"])
+    return snaps
+
+def save_snapshot(full_data, chave):
+    """Grava a carga da partição (empresa, filial) como snapshot versionado (gzip) e aplica a retenção"""
+    empresa, filial = chave
+    df = _snapshot_df(full_data)
+    with SNAPSHOT_LOCK:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        snaps = list_snapshots()
+        snap_id = snaps[-1]["id"] + 1 if snaps else 1
+        agora = time.localtime()
+        nome = f"sb2_{snap_id:06d}_{empresa}_{filial}_{time.strftime('%Y%m%d_%H%M%S', agora)}.json.gz"
+        payload = {
+            "formato": SNAPSHOT_FORMATO,
+            "id": snap_id,
+            "empresa": empresa,
+            "filial": filial,
+            "criado": time.strftime("%Y-%m-%d %H:%M:%S", agora),
+            "linhas": len(df),
+            "divergentes": int(df["has_diff"].sum()),
+            "dados": _df_to_colunas(df),
+        }
+        # Grava em arquivo temporário e renomeia, para nunca deixar snapshot pela metade
+        destino = os.path.join(SNAPSHOT_DIR, nome)
+        tmp = destino + ".tmp"
+        try:
+            with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+                json.dump(payload, f, separators=(",", ":"))
+            os.replace(tmp, destino)
+        except Exception:
+            # Disco cheio etc.: o .tmp não casa com _SNAPSHOT_RE e a retenção nunca o apagaria
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        _prune_snapshots(empresa, filial)
+        # Snapshots do formato 1 (sem partição) formam um grupo próprio de retenção
+        _prune_snapshots(None, None)
+
+    print(f"--- [SNAPSHOT] #{snap_id} {empresa}/{filial} gravado ({len(df)} linhas) ---")
+    return snap_id
+
+def _prune_snapshots(empresa, filial):
+    """
+    Remove snapshots da partição além do limite de quantidade/idade (sempre mantém o mais novo).
+    empresa/filial None = snapshots do formato 1; como não recebem mais cargas, a idade vale
+    para todos, inclusive o mais novo.
+    """
+    snaps = [s for s in list_snapshots() if s["empresa"] == empresa and s["filial"] == filial]
+    remover = snaps[:-SNAPSHOT_MAX] if SNAPSHOT_MAX > 0 else []
+    if SNAPSHOT_MAX_DIAS > 0:
+        limite = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() - SNAPSHOT_MAX_DIAS * 86400))
+        candidatos = snaps if empresa is None else snaps[:-1]
+        remover += [s for s in candidatos if s["criado"] < limite and s not in remover]
+    for s in remover:
+        try:
+            os.remove(os.path.join(SNAPSHOT_DIR, s["arquivo"]))
+        except OSError:
+            pass
+
+@lru_cache(maxsize=4)
+def _read_snapshot(arquivo):
+    with gzip.open(os.path.join(SNAPSHOT_DIR, arquivo), "rt", encoding="utf-8") as f:
+        payload = json.load(f)
+    payload["dados"] = _colunas_to_df(payload["dados"])
+    return payload
+
+def load_snapshot(snap_id):
+    """Carrega um snapshot pelo id. Retorna None se não existir, for de formato desconhecido ou estiver ilegível"""
+    for s in list_snapshots():
+        if s["id"] == snap_id:
+            try:
+                payload = _read_snapshot(s["arquivo"])
+            except (OSError, EOFError, ValueError, KeyError, TypeError) as e:
+                # gzip/JSON corrompido ou truncado: trata como snapshot ausente
+                print(f"--- [SNAPSHOT] Falha ao ler {s['arquivo']}: {e} ---")
+                return None
+            if payload.get("formato") == 1:
+                # Formato 1: carga única do SB2010, sem coluna empresa
+                dados = payload["dados"].copy()
+                dados.insert(0, "empresa", pd.Categorical(["01"] * len(dados)))
+                payload = dict(payload, formato=SNAPSHOT_FORMATO, empresa="01", filial=None, dados=dados)
+            if payload.get("formato") != SNAPSHOT_FORMATO:
+                return None
+            return payload
+    return None
+
+def _recorte_particao(payload, empresa, filial):
+    """Recorta um snapshot do formato 1 (todas as filiais do SB2010) para uma partição"""
+    if payload["filial"] is not None:
+        return payload
+    dados = payload["dados"]
+    dados = dados[(dados["empresa"].astype(str) == empresa) & (dados["filial"].astype(str) == filial)]
+    return dict(payload, empresa=empresa, filial=filial, dados=dados,
+                linhas=len(dados), divergentes=int(dados["has_diff"].sum()))
+
+def compute_drift(antigo, novo, limite=1000):
+    """
+    Compara dois snapshots pela chave (empresa, filial, cod, local) usando os dados colunares.
+    - novos_divergentes: has_diff passou a True (inclui linhas que surgiram já divergentes)
+    - resolvidos: era divergente e continua na carga, agora sem diff
+    - alterados: mesma situação de diff, mas algum valor mudou
+    Cada lista é limitada a `limite` linhas; os totais consideram todas.
+    """
+    df_de = antigo["dados"]
+    df_para = novo["dados"]
+    # Chaves em texto puro para o merge não depender das categorias de cada snapshot
+    esq = df_de.astype({c: str for c in SNAPSHOT_KEY})
+    dir_ = df_para.astype({c: str for c in SNAPSHOT_KEY})
+    m = esq.merge(dir_, on=SNAPSHOT_KEY, how="outer", suffixes=("_de", "_para"), indicator=True)
+
+    ambos = m["_merge"] == "both"
+    # Linhas que só existem de um lado vêm com NaN nas flags: eq(True) trata como False
+    diff_de = m["has_diff_de"].eq(True)
+    diff_para = m["has_diff_para"].eq(True)
+
+    mudou_valor = pd.Series(False, index=m.index)
+    for c in SNAPSHOT_VALORES:
+        mudou_valor |= (m[f"{c}_de"] - m[f"{c}_para"]).abs() > 0.000001
+
+    categorias = {
+        "novos_divergentes": diff_para & ~diff_de,
+        "resolvidos": ambos & diff_de & ~diff_para,
+        "alterados": ambos & (diff_de == diff_para) & mudou_valor,
+    }
+
+    colunas = SNAPSHOT_KEY + [f"{c}_{lado}" for c in SNAPSHOT_VALORES for lado in ("de", "para")] \
+        + ["has_diff_de", "has_diff_para"]
+
+    relatorio = {
+        "de": {k: antigo[k] for k in ("id", "empresa", "filial", "criado", "linhas", "divergentes")},
+        "para": {k: novo[k] for k in ("id", "empresa", "filial", "criado", "linhas", "divergentes")},
+        "totais": {
+            "entraram": int((m["_merge"] == "right_only").sum()),
+            "sairam": int((m["_merge"] == "left_only").sum()),
+        },
+    }
+    for nome, mask in categorias.items():
+        sel = m.loc[mask, colunas]
+        totais = {"linhas": int(mask.sum())}
+        for c in SNAPSHOT_VALORES:
+            totais[f"{c}_de"] = round(float(sel[f"{c}_de"].sum()), 2)
+            totais[f"{c}_para"] = round(float(sel[f"{c}_para"].sum()), 2)
+        relatorio["totais"][nome] = totais
+        # NaN (linha ausente de um lado) vira None para o JSON
+        linhas = sel.head(limite).astype(object).where(sel.head(limite).notna(), None)
+        relatorio[nome] = linhas.to_dict("records")
+    return relatorio
+
+def compute_drift_escopo(particoes, de_data=None, para_data=None, limite=1000):
+    """
+    Drift do escopo inteiro: para cada partição compara o último snapshot até `de_data`
+    com o último até `para_data` (datas "YYYY-MM-DD HH:MM:SS"; None = mais recente) e junta
+    os resultados. Sem `de_data`, compara com o snapshot anterior ao `para` da partição.
+    Se a partição não tiver snapshot 'de' próprio, usa o último do formato 1 (SB2010 inteiro)
+    recortado para a filial, assim o histórico anterior às partições continua comparável.
+    """
+    snaps = list_snapshots()
+    legado = [s for s in snaps if s["empresa"] is None]
+    categorias = ("novos_divergentes", "resolvidos", "alterados")
+    relatorio = {
+        "de_data": de_data,
+        "para_data": para_data,
+        "particoes": [],
+        "sem_historico": [],
+        "totais": {"entraram": 0, "sairam": 0},
+    }
+    for nome in categorias:
+        relatorio[nome] = []
+
+    for empresa, filial in particoes:
+        hist = [s for s in snaps if s["empresa"] == empresa and s["filial"] == filial]
+        cand_para = [s for s in hist if para_data is None or s["criado"] <= para_data]
+        if not cand_para:
+            relatorio["sem_historico"].append({"empresa": empresa, "filial": filial})
+            continue
+        s_para = cand_para[-1]
+        if de_data is None:
+            cand_de = [s for s in hist if s["id"] < s_para["id"]]
+            if not cand_de and empresa == "01":
+                cand_de = [s for s in legado if s["id"] < s_para["id"]]
+        else:
+            cand_de = [s for s in hist if s["criado"] <= de_data]
+            if not cand_de and empresa == "01":
+                cand_de = [s for s in legado if s["criado"] <= de_data]
+        antigo = load_snapshot(cand_de[-1]["id"]) if cand_de else None
+        novo = load_snapshot(s_para["id"])
+        if antigo is not None:
+            antigo = _recorte_particao(antigo, empresa, filial)
+        if antigo is None or novo is None:
+            relatorio["sem_historico"].append({"empresa": empresa, "filial": filial})
+            continue
+
+        parcial = compute_drift(antigo, novo, limite=limite)
+        relatorio["particoes"].append({
+            "empresa": empresa, "filial": filial, "de": parcial["de"], "para": parcial["para"],
+        })
+        for k, v in parcial["totais"].items():
+            if isinstance(v, dict):
+                acum = relatorio["totais"].setdefault(k, {})
+                for campo, valor in v.items():
+                    acum[campo] = round(acum.get(campo, 0) + valor, 2)
+            else:
+                relatorio["totais"][k] += v
+        for nome in categorias:
+            relatorio[nome].extend(parcial[nome])
+
+    for nome in categorias:
+        relatorio[nome] = relatorio[nome][:limite]
+    return relatorio
+
+def _parse_data_param(valor):
+    """Aceita "YYYY-MM-DD" (fim do dia) ou "YYYY-MM-DD HH:MM[:SS]"; retorna no formato dos snapshots"""
+    if not valor:
+        return None
+    valor = valor.replace("T", " ").strip()
+    for fmt, sufixo in (("%Y-%m-%d %H:%M:%S", ""), ("%Y-%m-%d %H:%M", ":59"), ("%Y-%m-%d", " 23:59:59")):
+        try:
+            time.strptime(valor, fmt)
+            return valor + sufixo
+        except ValueError:
+            continue
+    raise ValueError(f"Data inválida: '{valor}'. Use YYYY-MM-DD ou YYYY-MM-DD HH:MM:SS.")
 
 def apply_filter(data, filter_type, filter_year, filter_filial):
     # 0. Filtro de Filial
@@ -261,6 +777,25 @@ def apply_filter(data, filter_type, filter_year, filter_filial):
         return [item for item in data if not item['has_diff']]
     return data
 
+def particoes_da_requisicao(filter_filial='all'):
+    """Partições pedidas via ?escopo= (perfil) e ?empresa=, restritas pelo filtro de filial"""
+    return resolve_particoes(request.args.get('escopo'), request.args.get('empresa'), filter_filial)
+
+def escopo_query():
+    """'?escopo=&empresa=' da requisição atual, para os links manterem o escopo"""
+    params = {k: request.args[k] for k in ('escopo', 'empresa') if request.args.get(k)}
+    return "?" + urlencode(params) if params else ""
+
+def tabelas_display(particoes):
+    """Tabelas SB2xx0 das partições, para os títulos das telas"""
+    return ", ".join(sorted({tabela_sb2(emp) for emp, _f in particoes})) or "SB2"
+
+@app.errorhandler(EscopoErro)
+def escopo_erro(e):
+    if request.path.startswith(("/jobs/", "/snapshots")):
+        return jsonify({"erro": str(e)}), 400
+    return str(e), 400
+
 @app.route("/")
 def index():
     page = request.args.get('page', 1, type=int)
@@ -270,8 +805,17 @@ def index():
     force_reload = request.args.get('reload', '0') == '1'
     per_page = 100
 
-    # Pega dados do cache (ou carrega se necessário/forçado)
-    full_data = get_cached_data(force_reload=force_reload)
+    # Partições pedidas; se faltar alguma (ou recarga forçada) a carga vai para a fila
+    # de jobs e a tela mostra o progresso, sem prender o worker web no SQL
+    particoes = particoes_da_requisicao(filter_filial)
+    if force_reload or particoes_faltando(particoes):
+        try:
+            job = submit_carga(particoes, force_reload)
+        except queue.Full:
+            return "Fila de processamento cheia. Tente novamente em instantes.", 503
+        return render_template("carregando.html", status_url=f"/jobs/{job.id}", job_id=job.id)
+
+    full_data = get_cached_data(particoes=particoes)
     
     # Extrair anos disponíveis para o select
     # Varre t_dmov e p_dmov
@@ -316,9 +860,12 @@ def index():
     return render_template(
         "index.html",
         comparison_data=paginated_data,
-        filiais_list=FILIAIS,
-        filial_display=FILIAIS_STR, # Só p/ info header se quiser
-        last_update=CACHE_TIMESTAMP,
+        filiais_list=filiais_do_escopo(request.args.get('escopo'), request.args.get('empresa')),
+        tabelas_display=tabelas_display(particoes),
+        escopo_query=escopo_query(),
+        escopo_display=f"Escopo {request.args.get('escopo') or ESCOPO_PADRAO}: "
+                       + ", ".join(f"{emp}/{f}" for emp, f in particoes),
+        last_update=cache_timestamp(particoes),
         
         # Stats
         total_items=total_items, # Total filtrado
@@ -336,39 +883,88 @@ def index():
         available_years=sorted_years
     )
 
-def get_produtos_prod():
-    placeholders = ",".join("?" * len(FILIAIS))
-    sql = f"""
-        SELECT B2_FILIAL, B2_COD, B2_LOCAL, B2_VATU1, B2_CM1, B2_QATU, B2_DMOV
-          FROM SB2010
-         WHERE B2_FILIAL IN ({placeholders})
-         AND D_E_L_E_T_ = ''
-         AND B2_COD <> ''
-         AND (
-             B2_VATU1 <> 0 
-             OR B2_CM1 <> 0 
-         )
-         ORDER BY B2_FILIAL, B2_COD, B2_LOCAL
-    """
-    with connect_sql(PROD_SQL) as conn:
-        cur = conn.cursor()
-        cur.execute(sql, tuple(FILIAIS))
-        rows = cur.fetchall()
-        return [(_trim(r.B2_FILIAL), _trim(r.B2_COD), _trim(r.B2_LOCAL), r.B2_VATU1, r.B2_CM1, r.B2_QATU, _trim(r.B2_DMOV)) for r in rows]
+def get_produtos_prod(particoes=None, progress=None):
+    if particoes is None:
+        particoes = resolve_particoes()
+    return _query_sb2(PROD_SQL, particoes, progress, etapa="producao")
 
 # Endpoint sync removido para este modo de comparação
 
+@app.route("/snapshots")
+def snapshots():
+    return jsonify([
+        {k: s[k] for k in ("id", "empresa", "filial", "criado")}
+        for s in _snapshots_filtrados(request.args.get('empresa'), request.args.get('filial'))
+    ])
+
+def _snapshots_filtrados(empresa=None, filial=None):
+    return [
+        s for s in list_snapshots()
+        if (not empresa or s["empresa"] == empresa) and (not filial or s["filial"] == filial)
+    ]
+
+@app.route("/snapshots/drift")
+def snapshots_drift():
+    limite = request.args.get('limite', 1000, type=int)
+
+    # 1. Dois snapshots explícitos (?de=<id>&para=<id>), da mesma partição
+    if 'de' in request.args or 'para' in request.args:
+        id_de = request.args.get('de', type=int)
+        id_para = request.args.get('para', type=int)
+        if id_de is None or id_para is None:
+            return jsonify({"erro": "Informe os dois ids: ?de=&para=."}), 400
+
+        antigo = load_snapshot(id_de)
+        novo = load_snapshot(id_para)
+        if antigo is None or novo is None:
+            return jsonify({"erro": "Snapshot não encontrado."}), 404
+        # Formato 1 (SB2010 inteiro) contra uma partição da empresa 01: compara só aquela filial
+        if antigo["empresa"] == novo["empresa"]:
+            if antigo["filial"] is None and novo["filial"] is not None:
+                antigo = _recorte_particao(antigo, novo["empresa"], novo["filial"])
+            elif novo["filial"] is None and antigo["filial"] is not None:
+                novo = _recorte_particao(novo, antigo["empresa"], antigo["filial"])
+        if (antigo["empresa"], antigo["filial"]) != (novo["empresa"], novo["filial"]):
+            return jsonify({"erro": "Os snapshots 'de' e 'para' são de partições diferentes."}), 400
+
+        return jsonify(compute_drift(antigo, novo, limite=limite))
+
+    # 2. Escopo inteiro (?escopo=&empresa=&filial=), entre duas datas (?de_data=&para_data=)
+    try:
+        de_data = _parse_data_param(request.args.get('de_data'))
+        para_data = _parse_data_param(request.args.get('para_data'))
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
+
+    particoes = particoes_da_requisicao(request.args.get('filial', 'all'))
+    return jsonify(compute_drift_escopo(particoes, de_data, para_data, limite=limite))
+
 from openpyxl.cell import WriteOnlyCell
 
 import xlsxwriter
 
 @app.route("/export_excel")
 def export_excel():
-    # 0. Obter dados e filtro
+    # 0. Obter filtro
     filter_type = request.args.get('filter', 'all')
     filter_year = request.args.get('year', 'all')
     filter_filial = request.args.get('filial', 'all')
-    data = get_cached_data() 
+
+    particoes = particoes_da_requisicao(filter_filial)
+    output, filename = build_export_excel(filter_type, filter_year, filter_filial, particoes)
+
+    return send_file(
+        output,
+        mimetype=XLSX_MIMETYPE,
+        as_attachment=True,
+        download_name=filename
+    )
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def build_export_excel(filter_type, filter_year, filter_filial, particoes=None, progress=None):
+    """Gera o Excel da comparação. Retorna (BytesIO, nome_arquivo)"""
+    data = get_cached_data(progress=progress, particoes=particoes)
     if not data:
         data = []
     
@@ -400,9 +996,9 @@ def export_excel():
     text_fmt = workbook.add_format({})
 
     # 3. Cabeçalhos
-    # [Filial, Prod, Local, T_VATU, T_CM, T_QATU, T_DMOV, P_VATU, P_CM, P_QATU, P_DMOV]
+    # [Empresa, Filial, Prod, Local, T_VATU, T_CM, T_QATU, T_DMOV, P_VATU, P_CM, P_QATU, P_DMOV]
     headers = [
-        "FILIAL", "PRODUTO", "LOCAL", 
+        "EMPRESA", "FILIAL", "PRODUTO", "LOCAL", 
         "T_QATU", "T_VATU", "T_CM", "T_DMOV", 
         "P_QATU", "P_VATU", "P_CM", "P_DMOV"
     ]
@@ -410,10 +1006,11 @@ def export_excel():
         worksheet.write(0, col, h, header_fmt)
 
     # Ajuste largura colunas (aprox)
-    worksheet.set_column(0, 0, 10) # Filial
-    worksheet.set_column(1, 1, 20) # Produto
-    worksheet.set_column(2, 2, 10) # Local
-    worksheet.set_column(3, 10, 15) # Valores
+    worksheet.set_column(0, 0, 9) # Empresa
+    worksheet.set_column(1, 1, 10) # Filial
+    worksheet.set_column(2, 2, 20) # Produto
+    worksheet.set_column(3, 3, 10) # Local
+    worksheet.set_column(4, 11, 15) # Valores
 
     # Acumuladores de Totais
     sum_t_vatu = 0.0
@@ -427,6 +1024,8 @@ def export_excel():
     row_idx = 0
     for i, item in enumerate(data, start=1):
         row_idx = i
+        if progress and i % 1000 == 0:
+            progress(etapa="gravando", linhas_escritas=i, total=len(data))
         # Conversões
         # Conversões (Agora já são floats, mas garantindo default 0.0)
         t_vatu = item.get('t_vatu', 0.0)
@@ -448,65 +1047,67 @@ def export_excel():
         sum_p_qatu += p_qatu
 
         # Escrever células
-        # 0=Filial, 1=Prod, 2=Local
-        worksheet.write(row_idx, 0, item['filial'], text_fmt)
-        worksheet.write(row_idx, 1, item['cod'], text_fmt)
-        worksheet.write(row_idx, 2, item['local'], text_fmt)
+        # 0=Empresa, 1=Filial, 2=Prod, 3=Local
+        worksheet.write(row_idx, 0, item['empresa'], text_fmt)
+        worksheet.write(row_idx, 1, item['filial'], text_fmt)
+        worksheet.write(row_idx, 2, item['cod'], text_fmt)
+        worksheet.write(row_idx, 3, item['local'], text_fmt)
         
         # TESTE [QATU, VATU, CM, DMOV]
-        # Col 3..6
-        worksheet.write(row_idx, 3, t_qatu, normal_fmt)
-        worksheet.write(row_idx, 4, t_vatu, normal_fmt)
-        worksheet.write(row_idx, 5, t_cm, normal_fmt)
-        worksheet.write(row_idx, 6, t_dmov, text_fmt)
+        # Col 4..7
+        worksheet.write(row_idx, 4, t_qatu, normal_fmt)
+        worksheet.write(row_idx, 5, t_vatu, normal_fmt)
+        worksheet.write(row_idx, 6, t_cm, normal_fmt)
+        worksheet.write(row_idx, 7, t_dmov, text_fmt)
         
         # PROD [QATU, VATU, CM, DMOV]
-        # Col 7..10
+        # Col 8..11
         # Formatação Condicional na Linha (se diff valor)
         fmt_vatu = diff_fmt if item['diff_vatu'] else normal_fmt
         fmt_cm = diff_fmt if item['diff_cm'] else normal_fmt
         
-        worksheet.write(row_idx, 7, p_qatu, normal_fmt)
-        worksheet.write(row_idx, 8, p_vatu, fmt_vatu)
-        worksheet.write(row_idx, 9, p_cm, fmt_cm)
-        worksheet.write(row_idx, 10, p_dmov, text_fmt)
+        worksheet.write(row_idx, 8, p_qatu, normal_fmt)
+        worksheet.write(row_idx, 9, p_vatu, fmt_vatu)
+        worksheet.write(row_idx, 10, p_cm, fmt_cm)
+        worksheet.write(row_idx, 11, p_dmov, text_fmt)
 
     # 5. Escrever Totais na última linha
     last_row = row_idx + 1
     worksheet.write(last_row, 0, "TOTAL GERAL", total_fmt)
     worksheet.write(last_row, 1, "", total_fmt)
     worksheet.write(last_row, 2, "", total_fmt)
+    worksheet.write(last_row, 3, "", total_fmt)
     
     # Test Totais
-    worksheet.write(last_row, 3, sum_t_qatu, total_fmt)
-    worksheet.write(last_row, 4, sum_t_vatu, total_fmt)
-    worksheet.write(last_row, 5, sum_t_cm, total_fmt)
-    worksheet.write(last_row, 6, "", total_fmt)
+    worksheet.write(last_row, 4, sum_t_qatu, total_fmt)
+    worksheet.write(last_row, 5, sum_t_vatu, total_fmt)
+    worksheet.write(last_row, 6, sum_t_cm, total_fmt)
+    worksheet.write(last_row, 7, "", total_fmt)
 
     # Prod Totais
-    worksheet.write(last_row, 7, sum_p_qatu, total_fmt)
-    worksheet.write(last_row, 8, sum_p_vatu, total_fmt)
-    worksheet.write(last_row, 9, sum_p_cm, total_fmt)
-    worksheet.write(last_row, 10, "", total_fmt)
+    worksheet.write(last_row, 8, sum_p_qatu, total_fmt)
+    worksheet.write(last_row, 9, sum_p_vatu, total_fmt)
+    worksheet.write(last_row, 10, sum_p_cm, total_fmt)
+    worksheet.write(last_row, 11, "", total_fmt)
 
-    # 6. Fechar e Enviar
-    # 6. Fechar e Enviar
+    # 6. Fechar
     workbook.close()
     output.seek(0)
+    if progress:
+        progress(etapa="gravando", linhas_escritas=len(data), total=len(data))
     
     filter_label = f"_{filter_type}" if filter_type != 'all' else ""
     filename = f"comparacao_sb2{filter_label}_{time.strftime('%Y%m%d_%H%M')}.xlsx"
 
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    return output, filename
 
 @app.route("/importar")
 def importar():
-    return render_template("importar.html")
+    return render_template(
+        "importar.html",
+        tabelas_display=tabelas_display(particoes_da_requisicao()),
+        escopo_query=escopo_query(),
+    )
 
 @app.route("/upload_analise", methods=["POST"])
 def upload_analise():
@@ -518,139 +1119,179 @@ def upload_analise():
     if not (file.filename.endswith('.xls') or file.filename.endswith('.xlsx')):
         return "Formato inválido. Use .xls ou .xlsx", 400
 
+    particoes = particoes_da_requisicao()
     try:
-        # Ler Excel com Pandas
-        df = pd.read_excel(file, decimal=',', thousands='.')
-        
-        # Limpar nomes de colunas (strip e lower para busca)
-        df.columns = [str(c).strip() for c in df.columns]
-        cols_lower = {c.lower(): c for c in df.columns}
-        
-        # 1. Detectar Coluna de CÓDIGO
-        col_codigo = None
-        for c in df.columns:
-            if 'código' in c.lower() or 'codigo' in c.lower() or 'produto' in c.lower():
-                col_codigo = c
-                break
-        
-        # Fallback: coluna F (index 5) normal
-        if not col_codigo and len(df.columns) > 5:
-            col_codigo = df.columns[5]
-            
-        if not col_codigo:
-             return "Não foi possível identificar a coluna de 'Código' ou 'Produto'.", 400
-
-        # 2. Detectar Coluna de QUANTIDADE
-        col_qty = None
-        for c in df.columns:
-            if 'quant' in c.lower() or 'qtd' in c.lower() or 'saldo' in c.lower():
-                col_qty = c
-                break
-        
-        # 3. Detectar Coluna de VALOR
-        col_val = None
-        for c in df.columns:
-            # Evita "Unitário" se tiver "TOTAL" ou "VALOR"
-            if 'valor' in c.lower() or 'total' in c.lower() or ('custo' in c.lower() and 'unit' not in c.lower()):
-                col_val = c
-                break
-        # Se não achou 'Valor' ou 'Total', tenta Custo Unitário * Qtd depois? Não, melhor tentar só 'VALOR' como na imagem
-        if not col_val and 'valor' in cols_lower:
-            col_val = cols_lower['valor']
+        results = analisar_planilha(file, particoes)
+        # Salva no cache global para exportação (só o fluxo síncrono; jobs guardam o próprio resultado)
+        global LATEST_IMPORT_DATA
+        LATEST_IMPORT_DATA = results
+        return render_analise(results, particoes)
 
-        # Carregar dados da Base Teste
-        test_data_raw = get_produtos_teste()
+    except AnaliseErro as e:
+        return str(e), 400
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return f"Erro ao processar arquivo: {str(e)}", 500
+
+class AnaliseErro(Exception):
+    """Erro de conteúdo da planilha importada (vira HTTP 400)"""
+
+def analisar_planilha(file, particoes=None, progress=None):
+    """Compara a planilha importada com a Base Teste. Retorna a lista de resultados"""
+    # Ler Excel com Pandas
+    df = pd.read_excel(file, decimal=',', thousands='.')
+    
+    # Limpar nomes de colunas (strip e lower para busca)
+    df.columns = [str(c).strip() for c in df.columns]
+    cols_lower = {c.lower(): c for c in df.columns}
+    
+    # 1. Detectar Coluna de CÓDIGO
+    col_codigo = None
+    for c in df.columns:
+        if 'código' in c.lower() or 'codigo' in c.lower() or 'produto' in c.lower():
+            col_codigo = c
+            break
+    
+    # Fallback: coluna F (index 5) normal
+    if not col_codigo and len(df.columns) > 5:
+        col_codigo = df.columns[5]
         
-        # Agrupar dados de Teste em Dict: Código -> {qatu: sum, vatu: sum, details: str, filiais: set}
-        test_db_map = {}
+    if not col_codigo:
+         raise AnaliseErro("Não foi possível identificar a coluna de 'Código' ou 'Produto'.")
+
+    # 2. Detectar Coluna de QUANTIDADE
+    col_qty = None
+    for c in df.columns:
+        if 'quant' in c.lower() or 'qtd' in c.lower() or 'saldo' in c.lower():
+            col_qty = c
+            break
+    
+    # 3. Detectar Coluna de VALOR
+    col_val = None
+    for c in df.columns:
+        # Evita "Unitário" se tiver "TOTAL" ou "VALOR"
+        if 'valor' in c.lower() or 'total' in c.lower() or ('custo' in c.lower() and 'unit' not in c.lower()):
+            col_val = c
+            break
+    # Se não achou 'Valor' ou 'Total', tenta Custo Unitário * Qtd depois? Não, melhor tentar só 'VALOR' como na imagem
+    if not col_val and 'valor' in cols_lower:
+        col_val = cols_lower['valor']
+
+    # 4. Coluna de EMPRESA (obrigatória se o escopo tiver mais de uma empresa,
+    #    para não somar saldos de empresas diferentes no mesmo código)
+    if particoes is None:
+        particoes = resolve_particoes()
+    empresas = sorted({emp for emp, _f in particoes})
+    col_empresa = cols_lower.get('empresa') or cols_lower.get('emp')
+    if len(empresas) > 1 and not col_empresa:
+        raise AnaliseErro(
+            f"O escopo tem mais de uma empresa ({', '.join(empresas)}): inclua uma coluna 'EMPRESA' na planilha."
+        )
+
+    # Carregar dados da Base Teste e agrupar em Dict:
+    # (Empresa, Código) -> {qatu: sum, vatu: sum, locais: list, filiais: set}
+    test_db_map = {}
+    for emp in empresas:
+        test_data_raw = get_produtos_teste([p for p in particoes if p[0] == emp], progress)
         for r in test_data_raw:
             # r = (filial, cod, local, vatu1, cm1, qatu, dmov)
-            c_key = r[1].strip()
+            c_key = (emp, r[1].strip())
             if c_key not in test_db_map:
                 test_db_map[c_key] = {'qatu': 0.0, 'vatu': 0.0, 'locais': [], 'filiais': set()}
             
             test_db_map[c_key]['qatu'] += float(r[5] or 0)
             test_db_map[c_key]['vatu'] += float(r[3] or 0)
             test_db_map[c_key]['locais'].append(r[2]) # Apenas o local
-            test_db_map[c_key]['filiais'].add(r[0])   # Filial separada
-            
-        # Processar Lista Final
-        results = []
+            test_db_map[c_key]['filiais'].add(f"{emp}/{r[0]}")   # Empresa/Filial
         
-        for idx, row in df.iterrows():
-            code_val = str(row[col_codigo]).strip()
-            
-            # Dados do Excel (Importado)
-            try:
-                i_qatu = float(row[col_qty]) if col_qty else 0.0
-            except: i_qatu = 0.0
-            
-            try:
-                i_vatu = float(row[col_val]) if col_val else 0.0
-            except: i_vatu = 0.0
-            
-            # Dados do Banco (Teste)
-            db_entry = test_db_map.get(code_val)
-            found = db_entry is not None
-            
-            t_qatu = db_entry['qatu'] if found else 0.0
-            t_vatu = db_entry['vatu'] if found else 0.0
-            t_cm = (t_vatu / t_qatu) if t_qatu > 0 else 0.0
-            
-            # Separa Filiais e Locais
-            if found:
-                filiais_str = ", ".join(sorted(list(db_entry['filiais'])))
-                locais_str = ", ".join(sorted(list(set(db_entry['locais'])))) # unique locais
-            else:
-                filiais_str = ""
-                locais_str = ""
+    # Processar Lista Final
+    results = []
+    
+    total_linhas = len(df)
+    for idx, row in df.iterrows():
+        if progress and len(results) % 500 == 0:
+            progress(etapa="analisando", linhas_lidas=len(results), total=total_linhas)
+        code_val = str(row[col_codigo]).strip()
+        if col_empresa:
+            empresa_val = str(row[col_empresa]).strip()
+            # Excel costuma ler "01" como número
+            if empresa_val.endswith('.0'):
+                empresa_val = empresa_val[:-2]
+            if empresa_val.isdigit():
+                empresa_val = empresa_val.zfill(2)
+        else:
+            empresa_val = empresas[0] if empresas else ""
+        
+        # Dados do Excel (Importado)
+        try:
+            i_qatu = float(row[col_qty]) if col_qty else 0.0
+        except: i_qatu = 0.0
+        
+        try:
+            i_vatu = float(row[col_val]) if col_val else 0.0
+        except: i_vatu = 0.0
+        
+        # Dados do Banco (Teste)
+        db_entry = test_db_map.get((empresa_val, code_val))
+        found = db_entry is not None
+        
+        t_qatu = db_entry['qatu'] if found else 0.0
+        t_vatu = db_entry['vatu'] if found else 0.0
+        t_cm = (t_vatu / t_qatu) if t_qatu > 0 else 0.0
+        
+        # Separa Filiais e Locais
+        if found:
+            filiais_str = ", ".join(sorted(list(db_entry['filiais'])))
+            locais_str = ", ".join(sorted(list(set(db_entry['locais'])))) # unique locais
+        else:
+            filiais_str = ""
+            locais_str = ""
+        
+        # Diffs (com tolerância pequena)
+        diff_qatu = abs(t_qatu - i_qatu) > 0.01
+        diff_vatu = abs(t_vatu - i_vatu) > 0.01
+        has_diff = diff_qatu or diff_vatu
+        
+        results.append({
+            'empresa': empresa_val,
+            'cod': code_val,
+            'desc': row.get('Descrição', row.get('Descr', '')), # Tenta pegar descrição se tiver
+            'filiais': filiais_str,
+            'locais': locais_str,
             
-            # Diffs (com tolerância pequena)
-            diff_qatu = abs(t_qatu - i_qatu) > 0.01
-            diff_vatu = abs(t_vatu - i_vatu) > 0.01
-            has_diff = diff_qatu or diff_vatu
+            # Teste
+            't_qatu': t_qatu,
+            't_vatu': t_vatu,
+            't_cm': t_cm,
             
-            results.append({
-                'cod': code_val,
-                'desc': row.get('Descrição', row.get('Descr', '')), # Tenta pegar descrição se tiver
-                'filiais': filiais_str,
-                'locais': locais_str,
-                
-                # Teste
-                't_qatu': t_qatu,
-                't_vatu': t_vatu,
-                't_cm': t_cm,
-                
-                # Importado
-                'i_qatu': i_qatu,
-                'i_vatu': i_vatu,
-                
-                # Flags
-                'found': found,
-                'diff_qatu': diff_qatu,
-                'diff_vatu': diff_vatu,
-                'has_diff': has_diff,
-            })
+            # Importado
+            'i_qatu': i_qatu,
+            'i_vatu': i_vatu,
             
-        # Salva no cache global para exportação
-        global LATEST_IMPORT_DATA
-        LATEST_IMPORT_DATA = results
-
-        return render_template(
-            "importar_resultado.html",
-            data=results,
-            totals={
-                't_qatu': sum(r['t_qatu'] for r in results),
-                't_vatu': sum(r['t_vatu'] for r in results),
-                'i_qatu': sum(r['i_qatu'] for r in results),
-                'i_vatu': sum(r['i_vatu'] for r in results),
-            }
-        )
+            # Flags
+            'found': found,
+            'diff_qatu': diff_qatu,
+            'diff_vatu': diff_vatu,
+            'has_diff': has_diff,
+        })
         
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return f"Erro ao processar arquivo: {str(e)}", 500
+    return results
+
+def render_analise(results, particoes, export_url="/export_analise"):
+    return render_template(
+        "importar_resultado.html",
+        data=results,
+        export_url=export_url,
+        tabelas_display=tabelas_display(particoes),
+        escopo_query=escopo_query(),
+        totals={
+            't_qatu': sum(r['t_qatu'] for r in results),
+            't_vatu': sum(r['t_vatu'] for r in results),
+            'i_qatu': sum(r['i_qatu'] for r in results),
+            'i_vatu': sum(r['i_vatu'] for r in results),
+        }
+    )
 
 @app.route("/export_analise")
 def export_analise():
@@ -658,6 +1299,16 @@ def export_analise():
     if not LATEST_IMPORT_DATA:
         return "Nenhum dado disponível para exportação. Realize uma importação primeiro.", 400
 
+    output, filename = build_export_analise(LATEST_IMPORT_DATA)
+    return send_file(
+        output,
+        mimetype=XLSX_MIMETYPE,
+        as_attachment=True,
+        download_name=filename
+    )
+
+def build_export_analise(results):
+    """Gera o Excel do resultado da análise de importação. Retorna (BytesIO, nome_arquivo)"""
     output = io.BytesIO()
     workbook = xlsxwriter.Workbook(output, {'in_memory': True})
     worksheet = workbook.add_worksheet("Resultado Analise")
@@ -670,7 +1321,7 @@ def export_analise():
 
     # Cabeçalhos
     headers = [
-        "CÓDIGO", "DESCRIÇÃO", "STATUS", 
+        "EMPRESA", "CÓDIGO", "DESCRIÇÃO", "STATUS", 
         "FILIAIS", "LOCAIS",
         "QTD TESTE", "VALOR TESTE",
         "QTD IMPORTADA", "VALOR IMPORTADO"
@@ -679,45 +1330,290 @@ def export_analise():
         worksheet.write(0, col, h, header_fmt)
 
     # Ajuste colunas
-    worksheet.set_column(0, 0, 15) # Cod
-    worksheet.set_column(1, 1, 35) # Desc
-    worksheet.set_column(2, 2, 15) # Status
-    worksheet.set_column(3, 4, 15) # Filial/Local
-    worksheet.set_column(5, 8, 15) # Vals
+    worksheet.set_column(0, 0, 9) # Empresa
+    worksheet.set_column(1, 1, 15) # Cod
+    worksheet.set_column(2, 2, 35) # Desc
+    worksheet.set_column(3, 3, 15) # Status
+    worksheet.set_column(4, 5, 15) # Filial/Local
+    worksheet.set_column(6, 9, 15) # Vals
 
     # Dados
-    for i, item in enumerate(LATEST_IMPORT_DATA, start=1):
-        worksheet.write(i, 0, item['cod'], text_fmt)
-        worksheet.write(i, 1, item.get('desc', ''), text_fmt)
+    for i, item in enumerate(results, start=1):
+        worksheet.write(i, 0, item.get('empresa', ''), text_fmt)
+        worksheet.write(i, 1, item['cod'], text_fmt)
+        worksheet.write(i, 2, item.get('desc', ''), text_fmt)
         
         status = "CADASTRO OK" if item['found'] else "NÃO EXISTE"
-        worksheet.write(i, 2, status, text_fmt)
+        worksheet.write(i, 3, status, text_fmt)
         
-        worksheet.write(i, 3, item['filiais'], text_fmt)
-        worksheet.write(i, 4, item['locais'], text_fmt)
+        worksheet.write(i, 4, item['filiais'], text_fmt)
+        worksheet.write(i, 5, item['locais'], text_fmt)
         
         # Teste
-        worksheet.write(i, 5, item['t_qatu'], normal_fmt)
-        worksheet.write(i, 6, item['t_vatu'], normal_fmt)
+        worksheet.write(i, 6, item['t_qatu'], normal_fmt)
+        worksheet.write(i, 7, item['t_vatu'], normal_fmt)
         
         # Importado (Destaca Diff)
         fmt_qatu = diff_fmt if item['diff_qatu'] else normal_fmt
         fmt_vatu = diff_fmt if item['diff_vatu'] else normal_fmt
         
-        worksheet.write(i, 7, item['i_qatu'], fmt_qatu)
-        worksheet.write(i, 8, item['i_vatu'], fmt_vatu)
+        worksheet.write(i, 8, item['i_qatu'], fmt_qatu)
+        worksheet.write(i, 9, item['i_vatu'], fmt_vatu)
 
     workbook.close()
     output.seek(0)
     
     filename = f"resultado_analise_{time.strftime('%Y%m%d_%H%M')}.xlsx"
 
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    return output, filename
+
+# ---------------------------------------------------------------------------
+# Fila de jobs em background (recarga, exportação e importação)
+# ---------------------------------------------------------------------------
+
+JOBS_WORKERS = int(os.environ.get("SB2_JOBS_WORKERS", 2))
+# Jobs aguardando execução (cancelados não contam); acima disso o pedido é recusado (HTTP 503)
+JOBS_MAX_PENDENTES = int(os.environ.get("SB2_JOBS_MAX_PENDENTES", 10))
+# Tempo (s) que um job finalizado e seu resultado ficam disponíveis
+JOBS_TTL = int(os.environ.get("SB2_JOBS_TTL", 3600))
+# Limites dos jobs finalizados guardados: quantidade e tamanho total dos resultados (MB);
+# acima disso os mais antigos saem antes do TTL
+JOBS_MAX_FINALIZADOS = int(os.environ.get("SB2_JOBS_MAX_FINALIZADOS", 50))
+JOBS_MAX_RESULTADOS_MB = int(os.environ.get("SB2_JOBS_MAX_RESULTADOS_MB", 200))
+
+JOBS = {}
+JOBS_LOCK = threading.RLock()
+# Sem maxsize: o limite é verificado em submit_job, assim um job pendente cancelado
+# libera a vaga na hora (ele continua na fila, mas o worker só o descarta)
+JOBS_QUEUE = queue.Queue()
+_JOBS_THREADS = []
+
+class JobCancelado(Exception):
+    pass
+
+class Job:
+    def __init__(self, tipo, func, args):
+        self.id = uuid.uuid4().hex
+        self.tipo = tipo
+        self.func = func
+        self.args = args
+        self.status = "pendente"  # pendente | executando | concluido | erro | cancelado
+        self.progresso = {}
+        self.erro = None
+        self.resultado = None
+        self.resultado_bytes = 0
+        self.criado = time.time()
+        self.finalizado = None
+        # Quantos usuários acompanham o job (cargas são compartilhadas por submit_carga);
+        # cancelar só para o job quando o último desiste
+        self.interessados = 1
+        self._cancel = threading.Event()
+
+    def progress(self, **kwargs):
+        """Callback de progresso; também é o ponto onde o cancelamento é atendido"""
+        if self._cancel.is_set():
+            raise JobCancelado()
+        self.progresso.update(kwargs)
+
+    def cancel(self):
+        self._cancel.set()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "tipo": self.tipo,
+            "status": self.status,
+            "progresso": dict(self.progresso),
+            "erro": self.erro,
+            "criado": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.criado)),
+            "resultado_url": f"/jobs/{self.id}/resultado" if self.status == "concluido" else None,
+        }
+
+def _job_worker():
+    while True:
+        job = JOBS_QUEUE.get()
+        with JOBS_LOCK:
+            # Cancelado enquanto pendente: status/finalizado já foram gravados no cancelamento
+            if job._cancel.is_set():
+                JOBS_QUEUE.task_done()
+                continue
+            job.status = "executando"
+        try:
+            job.resultado = job.func(*job.args, progress=job.progress)
+            job.resultado_bytes = _resultado_bytes(job.resultado)
+            job.status = "concluido"
+        except JobCancelado:
+            job.status = "cancelado"
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            job.erro = str(e)
+            job.status = "erro"
+        finally:
+            job.finalizado = time.time()
+            JOBS_QUEUE.task_done()
+            with JOBS_LOCK:
+                _prune_jobs()
+
+def _resultado_bytes(resultado):
+    """Estimativa do tamanho em memória do resultado de um job"""
+    if isinstance(resultado, tuple) and resultado and isinstance(resultado[0], io.BytesIO):
+        return resultado[0].getbuffer().nbytes  # (workbook, nome_arquivo)
+    if isinstance(resultado, list) and resultado:
+        # Linhas da análise de importação (amostra da 1ª linha)
+        amostra = resultado[0]
+        por_linha = sys.getsizeof(amostra) + sum(sys.getsizeof(v) for v in amostra.values())
+        return sys.getsizeof(resultado) + por_linha * len(resultado)
+    return sys.getsizeof(resultado)
+
+def _prune_jobs():
+    """Remove jobs finalizados vencidos (TTL) e, acima dos limites, os mais antigos. Chamar com JOBS_LOCK"""
+    limite = time.time() - JOBS_TTL
+    for job_id in [j.id for j in JOBS.values() if j.finalizado and j.finalizado < limite]:
+        del JOBS[job_id]
+
+    finalizados = sorted((j for j in JOBS.values() if j.finalizado), key=lambda j: j.finalizado)
+    total = sum(j.resultado_bytes for j in finalizados)
+    max_bytes = JOBS_MAX_RESULTADOS_MB * 1024 * 1024
+    # O mais recente sempre fica, mesmo se sozinho passar do limite (senão o download nunca chega)
+    while len(finalizados) > 1 and (len(finalizados) > JOBS_MAX_FINALIZADOS or total > max_bytes):
+        job = finalizados.pop(0)
+        total -= job.resultado_bytes
+        del JOBS[job.id]
+
+def _get_job(job_id):
+    with JOBS_LOCK:
+        _prune_jobs()
+        return JOBS.get(job_id)
+
+def submit_job(tipo, func, *args):
+    """Enfileira func(*args, progress=cb). Levanta queue.Full se a fila estiver cheia"""
+    job = Job(tipo, func, args)
+    with JOBS_LOCK:
+        _prune_jobs()
+        # Workers sobem sob demanda (evita threads no processo pai do reloader)
+        while len(_JOBS_THREADS) < JOBS_WORKERS:
+            t = threading.Thread(target=_job_worker, name=f"sb2-job-{len(_JOBS_THREADS)}", daemon=True)
+            t.start()
+            _JOBS_THREADS.append(t)
+        pendentes = sum(1 for j in JOBS.values() if j.status == "pendente")
+        if pendentes >= JOBS_MAX_PENDENTES:
+            raise queue.Full()
+        JOBS_QUEUE.put_nowait(job)
+        JOBS[job.id] = job
+    return job
+
+def _job_reload(particoes, force_reload=True, progress=None):
+    data = get_cached_data(force_reload=force_reload, progress=progress, particoes=particoes)
+    return {"linhas": len(data), "atualizado": cache_timestamp(particoes)}
+
+def submit_carga(particoes, force_reload=True):
+    """Enfileira a carga das partições, reaproveitando um job igual ainda em andamento"""
+    args = (list(particoes), force_reload)
+    with JOBS_LOCK:
+        for job in JOBS.values():
+            if (job.tipo == "reload" and job.args == args and job.status in ("pendente", "executando")
+                    and not job._cancel.is_set()):
+                job.interessados += 1
+                return job
+        return submit_job("reload", _job_reload, *args)
+
+def _submit_carga_response(particoes, force_reload=True):
+    try:
+        job = submit_carga(particoes, force_reload)
+    except queue.Full:
+        return jsonify({"erro": "Fila de processamento cheia. Tente novamente em instantes."}), 503
+    return jsonify({"id": job.id, "status_url": f"/jobs/{job.id}"}), 202
+
+def _submit_response(tipo, func, *args):
+    try:
+        job = submit_job(tipo, func, *args)
+    except queue.Full:
+        return jsonify({"erro": "Fila de processamento cheia. Tente novamente em instantes."}), 503
+    return jsonify({"id": job.id, "status_url": f"/jobs/{job.id}"}), 202
+
+@app.route("/jobs/reload", methods=["POST"])
+def jobs_reload():
+    # Recarrega só as partições do filtro atual (?filial=, ?escopo=, ?empresa=)
+    particoes = particoes_da_requisicao(request.args.get('filial', 'all'))
+    return _submit_carga_response(particoes)
+
+@app.route("/jobs/export_excel", methods=["POST"])
+def jobs_export_excel():
+    filter_type = request.args.get('filter', 'all')
+    filter_year = request.args.get('year', 'all')
+    filter_filial = request.args.get('filial', 'all')
+    particoes = particoes_da_requisicao(filter_filial)
+    return _submit_response("export_excel", build_export_excel, filter_type, filter_year, filter_filial, particoes)
+
+@app.route("/jobs/upload_analise", methods=["POST"])
+def jobs_upload_analise():
+    file = request.files.get('file')
+    if not file:
+        return jsonify({"erro": "Nenhum arquivo enviado"}), 400
+    if not (file.filename.endswith('.xls') or file.filename.endswith('.xlsx')):
+        return jsonify({"erro": "Formato inválido. Use .xls ou .xlsx"}), 400
+
+    # O stream do upload morre com o request: copia o conteúdo para o job
+    conteudo = io.BytesIO(file.read())
+    return _submit_response("upload_analise", analisar_planilha, conteudo, particoes_da_requisicao())
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = _get_job(job_id)
+    if job is None:
+        return jsonify({"erro": "Job não encontrado."}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/jobs/<job_id>/cancelar", methods=["POST"])
+def job_cancelar(job_id):
+    job = _get_job(job_id)
+    if job is None:
+        return jsonify({"erro": "Job não encontrado."}), 404
+    with JOBS_LOCK:
+        if job.status in ("pendente", "executando") and job.interessados > 1:
+            # Carga compartilhada: quem cancelou só deixa de acompanhar, os outros seguem
+            job.interessados -= 1
+            return jsonify(dict(job.to_dict(), desanexado=True))
+        if job.status == "pendente":
+            # Ainda na fila: finaliza já (o worker só o descarta) e libera a vaga
+            job.cancel()
+            job.status = "cancelado"
+            job.finalizado = time.time()
+        elif job.status == "executando":
+            # Em execução: para no próximo ponto de progresso
+            job.cancel()
+    return jsonify(job.to_dict())
+
+@app.route("/jobs/<job_id>/resultado")
+def job_resultado(job_id):
+    job = _get_job(job_id)
+    if job is None:
+        return "Job não encontrado.", 404
+    if job.status != "concluido":
+        return f"Job ainda não concluído (status: {job.status}).", 409
+
+    if job.tipo == "export_excel":
+        output, filename = job.resultado
+        return send_file(
+            io.BytesIO(output.getvalue()),
+            mimetype=XLSX_MIMETYPE,
+            as_attachment=True,
+            download_name=filename
+        )
+    if job.tipo == "upload_analise":
+        # ?formato=xlsx exporta o resultado deste job (não o último import global)
+        if request.args.get('formato') == 'xlsx':
+            output, filename = build_export_analise(job.resultado)
+            return send_file(
+                output,
+                mimetype=XLSX_MIMETYPE,
+                as_attachment=True,
+                download_name=filename
+            )
+        # args = (conteudo, particoes): o título mostra as tabelas que o job analisou
+        return render_analise(job.resultado, job.args[1], export_url=f"/jobs/{job.id}/resultado?formato=xlsx")
+    return redirect(url_for('index'))
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=9901)